@@ -26,13 +26,32 @@ __license__ = "GPL"
 __maintainer__ = "Marc Sutton"
 __email__ = "marc@codev.uk"
 
+import os
 import re
 import sys
 import json
+import time
 import select
+import hashlib
+import tempfile
 import getpass
 import argparse
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+
+# Only needed for the dkim command: pip3 install dnspython
+try:
+    import dns.resolver
+except ImportError:
+    dns = None
+
+# Faster JSON parsing if available: pip3 install orjson
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 # Constants for the API
 ENDPOINT_PREFIX = "https://"
@@ -42,20 +61,32 @@ POP_CMD = "CMD_API_POP"
 FORWARDERS_CMD = "CMD_API_EMAIL_FORWARDERS"
 DNS_CMD = "CMD_API_DNS_CONTROL"
 DKIM_SUB = 'x._domainkey'
+DKIM_CHUNK = 250
 HEADERS = {"Content-Type": "application/json"}
+# Concurrent API requests, kept modest so a single DirectAdmin server isn't flooded
+MAX_WORKERS = 8
+DNS_WORKERS = 32
+ERROR_CONTENT_LIMIT = 4096
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'mxroute-tools')
 
 # Globals
 config = {}
+base_url = ''
+session = requests.Session()
 
 def get_config():
     """
     Process command line options.
 
     Returns a dictionary with config in it as well as placing it into a global called config.
+    Later calls return the same config without parsing the command line again.
     Exits on error after displaying messages.
     """
 
-    global config
+    global config, base_url
+    if config:
+        return config
+
     parser = argparse.ArgumentParser(
         prog="mxroute-tools",
         formatter_class=argparse.RawTextHelpFormatter,
@@ -74,106 +105,221 @@ fwd - create or update forwarders using text entered via stdin""")
     parser.add_argument('-p', '--pass',
                         help="Login key or password, will prompt if not present",
                         default='')
+    parser.add_argument('--cache-ttl',
+                        type=int, default=0, metavar='SECONDS',
+                        help="Reuse API responses cached by a previous run within this many seconds (default 0, disabled)")
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help="Don't read or write cached API responses, overrides --cache-ttl")
     config = vars(parser.parse_args())
 
     # Prompt for any missing arguments
     if not config['pass']:
         config['pass'] = getpass.getpass("Password or Login Key: ")
 
+    base_url = f"{ENDPOINT_PREFIX}{config['host']}{ENDPOINT_SUFFIX}/"
+
+    # Credentials, headers and the json parameter are sent with every request on the shared session
+    session.auth = (config['user'], config['pass'])
+    session.headers.update(HEADERS)
+    session.params = {'json': 'yes'}
+
+    # Retry with backoff on server errors or dropped connections rather than failing the whole run.
+    # Forwarder updates are GETs too, they are safe to retry as they set the forwarder to a fixed value.
+    retry_options = {'total': 4, 'backoff_factor': 0.3, 'status_forcelist': (500, 502, 503, 504)}
+    try:
+        retry = Retry(allowed_methods=frozenset(['GET']), **retry_options)
+    except TypeError:
+        # urllib3 before 1.26 calls this option method_whitelist
+        retry = Retry(method_whitelist=frozenset(['GET']), **retry_options)
+    # requests' default pool of 10 connections already covers MAX_WORKERS, sizing it from
+    # MAX_WORKERS just keeps the two in step if the worker count is ever raised
+    session.mount(ENDPOINT_PREFIX, HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=MAX_WORKERS))
+
     return config
 
+def get_cache_path(cmd, params):
+    """Returns the cache file used for a command and its parameters on the current server and user"""
+    key = hashlib.sha1(repr((config['host'], config['user'], cmd, sorted(params.items()))).encode()).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.json")
+
+def read_cache(path):
+    """Returns the cached response at path if it is younger than the cache TTL, otherwise None"""
+    try:
+        if time.time() - os.path.getmtime(path) > config['cache_ttl']:
+            return None
+        with open(path, encoding='utf-8') as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+def write_cache(path, data):
+    """Atomically save a response to the cache file at path, skipped if the cache can't be written"""
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as cache_file:
+            json.dump(data, cache_file)
+        os.replace(tmp_path, path)
+    except BaseException as e:
+        # Don't leave a partly written file behind
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        if not isinstance(e, OSError):
+            raise
+
+def clear_cache():
+    """Remove all cached responses, used after making changes on the server"""
+    try:
+        for name in os.listdir(CACHE_DIR):
+            if name.endswith('.json'):
+                os.remove(os.path.join(CACHE_DIR, name))
+    except OSError:
+        pass
+
 def make_api_request(cmd, params):
     """
     Make a call to the Direct Admin API taking the command and parameters.
+    Uses the shared session so the connection to the server is reused between calls.
+    Read only requests are served from the cache when --cache-ttl is set, unless --no-cache is given.
 
     Returns the response.
     """
-    url = f"{ENDPOINT_PREFIX}{config['host']}{ENDPOINT_SUFFIX}/{cmd}"
-    default_params = {'json': 'yes'}
-    request_params = {**default_params, **(params or {})}
+    params = params or {}
+    use_cache = (config.get('cache_ttl', 0) > 0 and not config.get('no_cache')
+                 and params.get('action', 'list') == 'list')
+    if use_cache:
+        cache_path = get_cache_path(cmd, params)
+        cached = read_cache(cache_path)
+        if cached is not None:
+            return cached
+    elif params.get('action', 'list') != 'list':
+        # Anything cached may now be out of date
+        clear_cache()
+
+    url = base_url + cmd
     try:
-        response = requests.get(url, auth=(config['user'], config['pass']),
-                                headers=HEADERS, params=request_params, timeout=10)
+        response = session.get(url, params=params, timeout=10)
         response.raise_for_status()  # Will raise an error for bad status codes
-        return response.json()
-    except json.decoder.JSONDecodeError as e:
-        # If JSON decoding fails then print the error and the original response text
+        data = json_loads(response.content)
+        if use_cache:
+            write_cache(cache_path, data)
+        return data
+    except json.decoder.JSONDecodeError as e:  # orjson.JSONDecodeError is a subclass of this
+        # If JSON decoding fails then print the error and the start of the original response
         print(f"ERROR: JSONDecodeError: {e}")
-        print("Response content:", response.text)
+        print("Response content:", response.content[:ERROR_CONTENT_LIMIT].decode('utf-8', 'replace'))
         raise
     except requests.RequestException as e:
         # Handle other request related errors
         print(f"ERROR: RequestException: {e}")
         raise
 
+def cancel_futures(futures):
+    """Cancel futures that haven't started yet so a failure doesn't wait for the rest of the queue"""
+    for future in futures:
+        future.cancel()
+
 def get_email_data_per_domain(cmd, domains, action='list'):
-    """Make a request per domains, returns a dictionary mapping domains to results"""
-    result = {}
-    for domain in domains:
-        response = make_api_request(cmd, {'domain': domain, 'action': action})
-        result[domain] = response
-    return result
+    """Make a request per domain concurrently, returns a dictionary mapping domains to results"""
+    return get_email_data_for_commands([cmd], domains, action)[0]
+
+def get_email_data_for_commands(cmds, domains, action='list'):
+    """
+    Make a request per command and domain, all running concurrently.
+
+    Returns a list with a dictionary mapping domains to results for each command.
+    """
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [{domain: executor.submit(make_api_request, cmd, {'domain': domain, 'action': action})
+                    for domain in domains}
+                   for cmd in cmds]
+        try:
+            return [{domain: future.result() for domain, future in cmd_futures.items()} for cmd_futures in futures]
+        except BaseException:
+            cancel_futures(future for cmd_futures in futures for future in cmd_futures.values())
+            raise
+
+def print_section(title, rows):
+    """Print a titled section of the report with a single write rather than a print per row"""
+    lines = [f"# {title} ({len(rows)})", *rows, ""]
+    sys.stdout.write("\n".join(lines) + "\n")
 
 def command_list(domains):
     """List information about domains"""
     # Get the list of domains
-    print(f"# Domains ({len(domains)})")
-    for domain in domains:
-        print(domain)
-    print()
-
-    # Get the list of mailboxes
-    email_boxes = get_email_data_per_domain(POP_CMD, domains)
-    box_count = sum(len(box) for box in email_boxes.values())
-    print(f"# Email Accounts ({box_count})")
-    for domain, boxes in email_boxes.items():
-        for box in boxes:
-            print(f"{box}@{domain}")
-    print()
-
-    # Get the list of forwarders
-    forwarders = get_email_data_per_domain(FORWARDERS_CMD, domains)
-    forwarder_count = sum(len(fwd) for fwd in forwarders.values())
-    print(f"# Forwarders ({forwarder_count})")
-    for domain, fwds in forwarders.items():
-        for fwd_from, fwd_to in fwds.items():
-            to = ",".join(fwd_to)
-            print(f"{fwd_from}@{domain} --> {to}")
-    print()
+    print_section("Domains", domains)
+
+    # Get the lists of mailboxes and forwarders together
+    email_boxes, forwarders = get_email_data_for_commands([POP_CMD, FORWARDERS_CMD], domains)
+
+    # List the mailboxes
+    print_section("Email Accounts", [f"{box}@{domain}" for domain, boxes in email_boxes.items() for box in boxes])
+
+    # List the forwarders
+    print_section("Forwarders", [f"{fwd_from}@{domain} --> {','.join(fwd_to)}"
+                                 for domain, fwds in forwarders.items() for fwd_from, fwd_to in fwds.items()])
+
+def get_dkim_from_api(domain):
+    """Get the DKIM value DirectAdmin has for a domain, or None if there isn't one"""
+    dns_data = make_api_request(DNS_CMD, {'domain': domain })
+    dkim_data = next((item for item in dns_data['records'] if item.get('name') == DKIM_SUB), None)
+    if dkim_data:
+        dkim_data = dkim_data['value']
+        dkim_data = dkim_data[1:len(dkim_data)-1]
+    return dkim_data
+
+def get_dkim_from_dns(domain):
+    """Look up the live DKIM value on DNS, returns 'NONE' if it can't be found"""
+    try:
+        dns_lookup = dns.resolver.resolve(f"{DKIM_SUB}.{domain}", 'TXT')[0]
+        return b''.join(dns_lookup.strings).decode('utf-8')
+    except Exception:
+        return 'NONE'
 
 def command_dkim(domains):
     """Check DKIM settings for domains"""
+    if dns is None:
+        print("ERROR: The dkim command requires dnspython, install it with: pip3 install dnspython")
+        sys.exit(1)
+
     print("* DKIM settings")
 
-    for domain in domains:
-        # Get the DKIM data for each domain
-        dns_data = make_api_request(DNS_CMD, {'domain': domain })
-        dkim_data = next((item for item in dns_data['records'] if item.get('name') == DKIM_SUB), None)
-        if dkim_data:
-            dkim_data = dkim_data['value']
-            dkim_data = dkim_data[1:len(dkim_data)-1]
-
-        # Now test if it matches by looking up the live value on DNS
-        # pip3 install dnspython
-        import dns.resolver
-        dkim_in_dns = ''
+    # Fetch the DKIM data from the API and from DNS for every domain at the same time,
+    # reporting on each domain as soon as both of its lookups have finished.
+    # DNS lookups get their own larger pool so they don't wait behind API requests.
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as api_executor, \
+            ThreadPoolExecutor(max_workers=DNS_WORKERS) as dns_executor:
+        lookups = [(domain, api_executor.submit(get_dkim_from_api, domain), dns_executor.submit(get_dkim_from_dns, domain))
+                   for domain in domains]
+
         try:
-            dns_lookup = dns.resolver.resolve(f"{DKIM_SUB}.{domain}", 'TXT')[0]
-            for txt_string in dns_lookup.strings:
-                dkim_in_dns = dkim_in_dns + txt_string.decode('utf-8')
-        except Exception:
-            dkim_in_dns = 'NONE'
-
-        if dkim_in_dns == dkim_data:
-            print(f"** DNS CORRECT for {domain}")
-        else:
-            if dkim_in_dns and dkim_in_dns != 'NONE':
-                print (f"** DNS SETUP for {domain}")
-            else:
-                print(f"** DNS FAILURE for {domain}")
-            dkim_split = ['"' + dkim_data[i:i+110] + '"' for i in range(0, len(dkim_data), 250)]
-            print(f"{DKIM_SUB} 3000 IN TXT " + " ".join(dkim_split))
-            print("")
+            for domain, api_future, dns_future in lookups:
+                dkim_data = api_future.result()
+                dkim_in_dns = dns_future.result()
+
+                if dkim_data is None:
+                    # DirectAdmin has no DKIM record for the domain so there is no TXT record to suggest
+                    print(f"** DNS FAILURE for {domain}")
+                elif dkim_in_dns == dkim_data:
+                    print(f"** DNS CORRECT for {domain}")
+                else:
+                    if dkim_in_dns and dkim_in_dns != 'NONE':
+                        print (f"** DNS SETUP for {domain}")
+                    else:
+                        print(f"** DNS FAILURE for {domain}")
+                    # TXT strings are limited to 255 characters so split the value into quoted chunks
+                    dkim_split = " ".join(f'"{dkim_data[i:i + DKIM_CHUNK]}"' for i in range(0, len(dkim_data), DKIM_CHUNK))
+                    print(f"{DKIM_SUB} 3000 IN TXT {dkim_split}")
+                    print("")
+        except BaseException:
+            cancel_futures(future for _, api_future, dns_future in lookups for future in (api_future, dns_future))
+            raise
 
 def command_fwd(domains):
     """Update forwarders with text from stdin"""